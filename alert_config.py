@@ -0,0 +1,298 @@
+"""
+Загрузка и кэширование конфигурации alerts_config.yaml.
+
+Кэш общий для всего процесса: файл перечитывается и разбирается заново
+только после его изменения. Пока работает watch_config(), изменения
+отслеживаются через watchfiles и os.stat на каждый запрос не вызывается.
+"""
+from typing import Optional, Dict, Any, List, Tuple
+import yaml
+import asyncio
+from contextlib import aclosing, suppress
+import glob
+import hashlib
+import logging
+import os
+import pickle
+import shlex
+import threading
+
+try:
+    import watchfiles
+except ImportError:
+    watchfiles = None
+
+logger = logging.getLogger(__name__)
+
+# === Загрузчик YAML ===
+# CSafeLoader (libyaml) разбирает конфиг в разы быстрее чистого Python-загрузчика
+YamlLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+CONFIG_PATH = "alerts_config.yaml"
+
+# Сколько байт stdout/stderr команды сохраняется по умолчанию
+DEFAULT_MAX_OUTPUT_BYTES = 16 * 1024
+
+# Версия формата дискового кэша; увеличивается при изменении структуры commands_by_id
+# или правил её построения
+_CACHE_FORMAT = 4
+
+
+class ConfigError(Exception):
+    """Файл конфигурации не удалось разобрать или он имеет неверную структуру."""
+
+
+# === Кэш конфигурации ===
+# path -> (st_mtime_ns, st_size, st_ino, config, commands_by_id)
+_CONFIG_CACHE: Dict[str, tuple] = {}
+_CONFIG_LOCK = threading.Lock()
+# Пути, изменения которых отслеживает watch_config()
+_WATCHED: set = set()
+# Как часто watchfiles возвращает управление без событий, и как часто
+# проверяется появление удалённого файла конфигурации
+_WATCH_TIMEOUT_MS = 1000
+_WATCH_RETRY_SECONDS = 1.0
+
+
+def load_config(path: Optional[str] = None) -> Tuple[Dict[str, Any], Dict[str, Dict[str, Any]]]:
+    """
+    Возвращает разобранную конфигурацию и построенную по ней карту команд
+    alert_id -> {"shell", "capture_output", "max_output_bytes",
+    "commands": [(шаблон, argv или None), ...]},
+    перечитывая файл только при изменении (st_mtime_ns, st_size, st_ino).
+    По умолчанию читается CONFIG_PATH. Если файла нет — FileNotFoundError,
+    если его не удалось разобрать — ConfigError.
+
+    Для путей, которые отслеживает watch_config(), закэшированная
+    конфигурация возвращается без обращения к файловой системе.
+
+    Возвращаемые объекты общие для всех запросов: только чтение, не изменять.
+    """
+    path = path or CONFIG_PATH
+    if path in _WATCHED:
+        cached = _CONFIG_CACHE.get(path)
+        if cached is not None:
+            return cached[3], cached[4]
+    st = os.stat(path)
+    key = (st.st_mtime_ns, st.st_size, st.st_ino)
+    with _CONFIG_LOCK:
+        cached = _CONFIG_CACHE.get(path)
+        if cached is not None and cached[:3] == key:
+            return cached[3], cached[4]
+        with open(path, "rb") as f:
+            data = f.read()
+        config, commands_by_id = _parse_config(path, data)
+        _CONFIG_CACHE[path] = (*key, config, commands_by_id)
+        logger.info("Конфигурация '%s' загружена", path)
+        return config, commands_by_id
+
+
+def invalidate(path: Optional[str] = None) -> None:
+    """Сбрасывает кэш конфигурации; следующий load_config() перечитает файл."""
+    with _CONFIG_LOCK:
+        _CONFIG_CACHE.pop(path or CONFIG_PATH, None)
+
+
+async def watch_config(path: Optional[str] = None, stop_event: Optional[asyncio.Event] = None) -> None:
+    """
+    Отслеживает изменения файла конфигурации и сбрасывает кэш при каждом
+    изменении. Следит только за самим файлом; если файл удалён или заменён
+    новым (так сохраняют многие редакторы), наблюдение запускается заново.
+    Работает до установки stop_event. Без пакета watchfiles сразу
+    завершается — тогда изменения определяются по os.stat.
+    """
+    path = path or CONFIG_PATH
+    if watchfiles is None:
+        logger.warning("watchfiles не установлен, изменения '%s' проверяются на каждый запрос", path)
+        return
+
+    try:
+        while stop_event is None or not stop_event.is_set():
+            # Пока наблюдение не запущено, load_config() проверяет файл через os.stat
+            _WATCHED.discard(path)
+            if not os.path.exists(path):
+                await _wait_stop(stop_event, _WATCH_RETRY_SECONDS)
+                continue
+            try:
+                await _watch_until_replaced(path, stop_event)
+            except FileNotFoundError:
+                continue
+    finally:
+        _WATCHED.discard(path)
+
+
+async def _watch_until_replaced(path: str, stop_event: Optional[asyncio.Event]) -> None:
+    """
+    Наблюдает за файлом, пока он не будет удалён или заменён, либо до stop_event.
+    awatch() с yield_on_timeout отдаёт первое значение уже после регистрации
+    наблюдения: в этот момент файл проверяется ещё раз (изменения до регистрации
+    не придут событием), и только после этого os.stat на запрос отключается.
+    """
+    changes_iter = watchfiles.awatch(
+        path,
+        watch_filter=None,
+        stop_event=stop_event,
+        rust_timeout=_WATCH_TIMEOUT_MS,
+        yield_on_timeout=True
+    )
+    async with aclosing(changes_iter):
+        async for changes in changes_iter:
+            if path not in _WATCHED:
+                try:
+                    load_config(path)
+                except (FileNotFoundError, ConfigError):
+                    pass
+                _WATCHED.add(path)
+            if not changes:
+                continue
+            logger.info("Файл конфигурации '%s' изменён, кэш сброшен", path)
+            invalidate(path)
+            if any(change == watchfiles.Change.deleted for change, _ in changes):
+                return
+
+
+async def _wait_stop(stop_event: Optional[asyncio.Event], timeout: float) -> None:
+    """Ждёт timeout секунд или установки stop_event, смотря что наступит раньше."""
+    if stop_event is None:
+        await asyncio.sleep(timeout)
+        return
+    with suppress(asyncio.TimeoutError):
+        await asyncio.wait_for(stop_event.wait(), timeout)
+
+
+# === Дисковый кэш разобранной конфигурации ===
+def _parse_config(path: str, data: bytes) -> Tuple[Dict[str, Any], Dict[str, Dict[str, Any]]]:
+    """
+    Разбирает содержимое конфигурации. Результат сохраняется рядом с YAML
+    в '<path>.cache.v<формат>.<hash>.pkl', где hash — blake2b от содержимого файла:
+    при следующих запусках с тем же содержимым YAML не разбирается вовсе.
+    Ошибки дискового кэша не критичны — конфигурация просто разбирается заново.
+    """
+    digest = hashlib.blake2b(data, digest_size=16).hexdigest()
+    cache_path = f"{path}.cache.v{_CACHE_FORMAT}.{digest}.pkl"
+
+    try:
+        with open(cache_path, "rb") as f:
+            config, commands_by_id, problems = pickle.load(f)
+        logger.info("Конфигурация '%s' загружена из кэша '%s'", path, cache_path)
+        # Ошибки разбора сохранены в кэше: повторяем их, чтобы они не терялись при рестартах
+        for problem in problems:
+            logger.error("%s", problem)
+        return config, commands_by_id
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.warning("Не удалось прочитать кэш конфигурации '%s': %s", cache_path, e)
+
+    try:
+        config = yaml.load(data, Loader=YamlLoader) or {}
+    except yaml.YAMLError as e:
+        raise ConfigError(f"YAML parse error: {e}") from e
+    if not isinstance(config, dict):
+        raise ConfigError("top level of the configuration must be a mapping")
+    if not isinstance(config.get("alert", []), list):
+        raise ConfigError("'alert' must be a list")
+    problems: List[str] = []
+    commands_by_id = _build_commands(config, problems)
+    _write_cache(path, cache_path, (config, commands_by_id, problems))
+    return config, commands_by_id
+
+
+def _write_cache(path: str, cache_path: str, parsed: tuple) -> None:
+    """
+    Атомарно записывает кэш (через временный файл и os.replace), чтобы
+    параллельные воркеры не прочитали недописанный файл, и удаляет кэши
+    от прежних версий конфигурации.
+    """
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            pickle.dump(parsed, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        logger.warning("Не удалось записать кэш конфигурации '%s': %s", cache_path, e)
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        return
+
+    for stale_path in glob.glob(f"{glob.escape(path)}.cache.*.pkl"):
+        if stale_path != cache_path:
+            try:
+                os.remove(stale_path)
+            except OSError:
+                pass
+
+
+def _report(problems: List[str], msg: str, *args: Any) -> None:
+    """Логирует ошибку конфигурации и запоминает её для сохранения в кэше."""
+    problem = msg % args
+    logger.error("%s", problem)
+    problems.append(problem)
+
+
+def _build_commands(config: Dict[str, Any], problems: List[str]) -> Dict[str, Dict[str, Any]]:
+    """
+    Строит карту alert_id -> команды. 'command' приводится к списку, каждая
+    команда заранее разбивается на argv. Для алертов с 'shell: true' argv
+    не строится — такие команды выполняются через /bin/sh. Если команду
+    не удалось разобрать (или она не строка), вместо argv сохраняется None.
+
+    'capture_output: false' отключает сохранение stdout команд алерта,
+    'max_output_bytes' ограничивает объём сохраняемого stdout/stderr.
+    Найденные ошибки логируются и добавляются в problems.
+    """
+    commands_by_id = {}
+    for item in config.get("alert", []):
+        if not isinstance(item, dict):
+            _report(problems, "Некорректный элемент списка 'alert' пропущен: %r", item)
+            continue
+        for alert_id, settings in item.items():
+            if alert_id in commands_by_id or not isinstance(settings, dict):
+                continue
+            commands = settings.get("command")
+            if not commands:
+                continue
+            if not isinstance(commands, list):
+                commands = [commands]
+
+            use_shell = bool(settings.get("shell"))
+            prepared = []
+            for cmd in commands:
+                argv = None
+                if not isinstance(cmd, str):
+                    _report(problems, "Команда %r для alert_id '%s' должна быть строкой", cmd, alert_id)
+                elif not use_shell:
+                    try:
+                        argv = shlex.split(cmd)
+                    except ValueError as e:
+                        _report(problems, "Не удалось разобрать команду '%s' для alert_id '%s': %s",
+                                cmd, alert_id, e)
+                prepared.append((cmd, argv))
+
+            max_output_bytes = settings.get("max_output_bytes", DEFAULT_MAX_OUTPUT_BYTES)
+            # bool — подкласс int: 'max_output_bytes: true' не должен превращаться в 1 байт
+            if (isinstance(max_output_bytes, bool) or not isinstance(max_output_bytes, int)
+                    or max_output_bytes < 0):
+                _report(
+                    problems, "Некорректное значение max_output_bytes '%s' для alert_id '%s', используется %s",
+                    max_output_bytes, alert_id, DEFAULT_MAX_OUTPUT_BYTES
+                )
+                max_output_bytes = DEFAULT_MAX_OUTPUT_BYTES
+
+            capture_output = settings.get("capture_output", True)
+            if not isinstance(capture_output, bool):
+                _report(
+                    problems, "Некорректное значение capture_output '%s' для alert_id '%s', используется true",
+                    capture_output, alert_id
+                )
+                capture_output = True
+
+            commands_by_id[alert_id] = {
+                "shell": use_shell,
+                "capture_output": capture_output,
+                "max_output_bytes": max_output_bytes,
+                "commands": prepared
+            }
+    return commands_by_id
@@ -1,35 +1,144 @@
 from fastapi import FastAPI, HTTPException, Request
+from fastapi.encoders import jsonable_encoder
 from fastapi.exceptions import RequestValidationError
-from pydantic import BaseModel
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel, ConfigDict
 from typing import List, Optional, Dict, Any
 import yaml
+import orjson
+import asyncio
 import subprocess
 import logging
+from logging.handlers import QueueHandler, QueueListener
+import queue
+import atexit
+from contextlib import asynccontextmanager, suppress
 from datetime import datetime
 import os
+import re
+import signal
+import shlex
+
+import alert_config
 
 # === Настройка логгирования ===
 log_file = "alert_executor.log"
 
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(message)s",
-    handlers=[
-        logging.FileHandler(log_file),
-        logging.StreamHandler()
-    ]
-)
+
+def _setup_logging() -> bool:
+    """
+    Обработчики запросов только кладут записи в очередь,
+    запись в файл и консоль выполняется в отдельном потоке.
+
+    Воркеры uvicorn запускаются через multiprocessing "spawn" и выполняют
+    этот модуль дважды (как __mp_main__ и как main), поэтому повторный
+    вызов ничего не делает. Возвращает True, если логгирование настроено сейчас.
+    """
+    root_logger = logging.getLogger()
+    if any(isinstance(h, QueueHandler) for h in root_logger.handlers):
+        return False
+
+    log_queue = queue.Queue(-1)
+    log_formatter = logging.Formatter("%(asctime)s [%(levelname)s] %(message)s")
+
+    file_handler = logging.FileHandler(log_file)
+    file_handler.setFormatter(log_formatter)
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(log_formatter)
+
+    root_logger.setLevel(logging.INFO)
+    root_logger.addHandler(QueueHandler(log_queue))
+
+    log_listener = QueueListener(log_queue, file_handler, stream_handler)
+    log_listener.start()
+    atexit.register(log_listener.stop)
+    return True
+
 
 logger = logging.getLogger(__name__)
 
+if _setup_logging():
+    # === Загрузчик YAML ===
+    if alert_config.YamlLoader is yaml.SafeLoader:
+        logger.warning("libyaml недоступна, используется медленный yaml.SafeLoader")
+    else:
+        logger.info("Для разбора конфигурации используется yaml.CSafeLoader (libyaml)")
+
+
+# alert_id — сегмент пути сразу после '/grafana/' (до '/', '?' или '#')
+_ALERT_ID_RE = re.compile(r"/grafana/([^/?#]+)")
+
+# === Ограничение параллельных команд ===
+# Не даёт пачке одновременных алертов запустить неограниченное число процессов
+def _max_concurrent_cmds(default: int = 16) -> int:
+    """Читает ALERT_MAX_CONCURRENCY; некорректные значения заменяются безопасными."""
+    raw = os.environ.get("ALERT_MAX_CONCURRENCY", str(default))
+    try:
+        value = int(raw)
+    except ValueError:
+        logger.error("Некорректное значение ALERT_MAX_CONCURRENCY '%s', используется %s", raw, default)
+        return default
+    if value < 1:
+        logger.error("ALERT_MAX_CONCURRENCY должно быть не меньше 1 (задано %s), используется 1", value)
+        return 1
+    return value
+
+
+MAX_CONCURRENT_CMDS = _max_concurrent_cmds()
+_CMD_SEM = asyncio.Semaphore(MAX_CONCURRENT_CMDS)
+
+
+# === Ответы ===
+class OrjsonResponse(JSONResponse):
+    """JSON-ответ, сериализуемый через orjson вместо стандартного json."""
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content)
+
+
+# === Жизненный цикл приложения ===
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Загружает конфигурацию до первого запроса и на время работы
+    приложения запускает отслеживание её изменений.
+    """
+    # Ошибки конфигурации не мешают запуску: о них сообщит обработчик алертов
+    try:
+        alert_config.load_config()
+    except FileNotFoundError:
+        logger.error("Файл конфигурации '%s' не найден.", alert_config.CONFIG_PATH)
+    except alert_config.ConfigError as e:
+        logger.error("Ошибка в файле конфигурации '%s': %s", alert_config.CONFIG_PATH, e)
+
+    stop_watching = asyncio.Event()
+    watcher = asyncio.create_task(alert_config.watch_config(stop_event=stop_watching))
+    try:
+        yield
+    finally:
+        # Останавливаем через событие, а не отменой задачи, чтобы поток
+        # watchfiles завершился до остановки процесса
+        stop_watching.set()
+        try:
+            await asyncio.wait_for(watcher, timeout=5)
+        except asyncio.TimeoutError:
+            logger.warning("Отслеживание конфигурации не остановилось вовремя")
+
+
 app = FastAPI(
     title="Alert Executor API",
     description="API для выполнения команд при получении алертов из Alertmanager / Grafana.",
-    version="1.0"
+    version="1.0",
+    default_response_class=OrjsonResponse,
+    lifespan=lifespan
 )
 
 # === Модели для валидации JSON-запросов ===
+# Поля, которые сервису не нужны (startsAt, fingerprint, values и т.п.),
+# отбрасываются при валидации и не хранятся в моделях
 class Alert(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+
     status: str
     labels: Dict[str, str]
     annotations: Dict[str, str]
@@ -37,6 +146,8 @@ class Alert(BaseModel):
 
 
 class AlertRequest(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+
     receiver: str
     status: str
     alerts: List[Alert]
@@ -48,80 +159,213 @@ class AlertRequest(BaseModel):
 # === Обработчик ошибок валидации ===
 @app.exception_handler(RequestValidationError)
 async def validation_exception_handler(request: Request, exc: Exception):
-    logger.error(f"Ошибка валидации запроса: {exc}")
-    return {
-        "status": "error",
-        "detail": exc.errors(),
-        "body": exc.body
-    }
+    logger.error("Ошибка валидации запроса: %s", exc)
+    return OrjsonResponse(
+        jsonable_encoder({
+            "status": "error",
+            "detail": exc.errors(),
+            "body": exc.body
+        }),
+        status_code=422
+    )
 
 
 # === Вспомогательный класс для безопасной подстановки ===
 class SafeDict(dict):
     def __missing__(self, key):
-        logger.warning(f"Метка '{key}' не найдена в labels, подставлена пустая строка.")
+        logger.warning("Метка '%s' не найдена в labels, подставлена пустая строка.", key)
         return ""
 
 
+# Таймаут выполнения команды и ожидания её завершения после SIGKILL, в секундах
+COMMAND_TIMEOUT = 60
+_KILL_WAIT_TIMEOUT = 5
+
+
+async def _read_limited(stream: Optional[asyncio.StreamReader], limit: int) -> bytes:
+    """
+    Читает поток до конца, сохраняя не больше limit байт; остаток
+    вычитывается и отбрасывается, чтобы процесс не завис на полном канале.
+    """
+    if stream is None:
+        return b""
+    buf = bytearray()
+    while True:
+        chunk = await stream.read(65536)
+        if not chunk:
+            return bytes(buf)
+        if len(buf) < limit:
+            buf += chunk[:limit - len(buf)]
+
+
+async def _run_command(
+    alert_name: str,
+    alert_id: str,
+    cmd_template: str,
+    cmd: str,
+    argv: Optional[List[str]] = None,
+    capture_output: bool = True,
+    max_output_bytes: int = alert_config.DEFAULT_MAX_OUTPUT_BYTES
+) -> Dict[str, Any]:
+    """
+    Выполняет команду и возвращает словарь с результатом для ответа.
+    Если передан argv, процесс запускается напрямую, без оболочки;
+    иначе строка cmd выполняется через /bin/sh.
+    При capture_output=False stdout команды отправляется в /dev/null;
+    сохраняется не больше max_output_bytes байт stdout и stderr.
+    """
+    logger.info("Выполняется команда: %s", cmd)
+    stdout_target = subprocess.PIPE if capture_output else subprocess.DEVNULL
+    async with _CMD_SEM:
+        try:
+            if argv is not None:
+                proc = await asyncio.create_subprocess_exec(
+                    *argv,
+                    stdout=stdout_target,
+                    stderr=subprocess.PIPE,
+                    start_new_session=True
+                )
+            else:
+                proc = await asyncio.create_subprocess_shell(
+                    cmd,
+                    stdout=stdout_target,
+                    stderr=subprocess.PIPE,
+                    start_new_session=True
+                )
+            try:
+                out, err, _ = await asyncio.wait_for(
+                    asyncio.gather(
+                        _read_limited(proc.stdout, max_output_bytes),
+                        _read_limited(proc.stderr, max_output_bytes),
+                        proc.wait()
+                    ),
+                    timeout=COMMAND_TIMEOUT
+                )
+            except asyncio.TimeoutError:
+                # Команда запущена в своей группе процессов: убиваем всю группу,
+                # иначе дочерние процессы команды держат каналы открытыми
+                with suppress(ProcessLookupError):
+                    os.killpg(proc.pid, signal.SIGKILL)
+                try:
+                    await asyncio.wait_for(proc.wait(), timeout=_KILL_WAIT_TIMEOUT)
+                except asyncio.TimeoutError:
+                    logger.error("Процесс команды не завершился после SIGKILL: %s", cmd)
+                logger.error("Таймаут выполнения команды: %s", cmd)
+                return {
+                    "alert": alert_name,
+                    "alert_id": alert_id,
+                    "command_template": cmd_template,
+                    "command_executed": cmd,
+                    "status": "timeout",
+                    "stdout": "",
+                    "stderr": "Command timed out"
+                }
+        except OSError as e:
+            logger.error("Не удалось запустить команду '%s': %s", cmd, e)
+            return {
+                "alert": alert_name,
+                "alert_id": alert_id,
+                "command_template": cmd_template,
+                "command_executed": cmd,
+                "status": "failed",
+                "stdout": "",
+                "stderr": str(e)
+            }
+
+    stdout = out.decode(errors="replace").strip() if out else ""
+    stderr = err.decode(errors="replace").strip() if err else ""
+
+    if proc.returncode != 0:
+        logger.error("Ошибка при выполнении команды '%s': код возврата %s", cmd, proc.returncode)
+        logger.error("STDOUT: %s", stdout or "(пусто)")
+        logger.error("STDERR: %s", stderr or "(пусто)")
+        status = "failed"
+    else:
+        logger.info("STDOUT: %s", stdout)
+        if stderr:
+            logger.warning("STDERR: %s", stderr)
+        status = "success"
+
+    return {
+        "alert": alert_name,
+        "alert_id": alert_id,
+        "command_template": cmd_template,
+        "command_executed": cmd,
+        "status": status,
+        "stdout": stdout,
+        "stderr": stderr
+    }
+
+
 # === Роуты ===
 @app.post("/alert")
-def handle_alert(data: AlertRequest):
+@app.post("/")
+async def handle_alert(data: AlertRequest):
     """
     Принимает POST-запрос с данными алерта.
     Обрабатывает только алерты со статусом 'firing'.
+    Корневой путь '/' оставлен для вебхуков, настроенных на адрес сервиса без '/alert'.
     """
     try:
         logger.info("Получен новый запрос с алертами")
 
         results = []
+        # (позиция в results, корутина выполнения команды)
+        pending = []
+
+        # Конфигурация загружается не больше одного раза на запрос и только
+        # когда она действительно нужна (есть firing алерт с alert_id)
+        config_loaded = False
+        commands_by_id = None
+        config_error = None
 
         for alert in data.alerts:
             alert_status = alert.status.lower()
             alert_name = alert.labels.get("alertname", "unknown")
             generator_url = alert.generatorURL
 
-            logger.info(f"Обработка алерта '{alert_name}' со статусом '{alert_status}'")
+            logger.info("Обработка алерта '%s' со статусом '%s'", alert_name, alert_status)
 
             # Фильтр: обрабатываем только firing алерты
             if alert_status != "firing":
-                logger.info(f"Алерт '{alert_name}' со статусом '{alert_status}' игнорируется.")
+                logger.info("Алерт '%s' со статусом '%s' игнорируется.", alert_name, alert_status)
                 continue
 
             # Извлечение alert_id из generatorURL
-            parts = generator_url.split('/')
-            try:
-                grafana_index = parts.index('grafana')
-                alert_id = parts[grafana_index + 1]
-                logger.info(f"Извлечён alert_id: {alert_id}")
-            except (ValueError, IndexError) as e:
-                logger.error(f"Не удалось найти alert_id в generatorURL: {e}")
+            match = _ALERT_ID_RE.search(generator_url)
+            if not match:
+                logger.error("Не удалось найти alert_id в generatorURL: %s", generator_url)
                 results.append({
                     "alert": alert_name,
                     "error": f"Invalid generatorURL format: {generator_url}"
                 })
                 continue
+            alert_id = match.group(1)
+            logger.info("Извлечён alert_id: %s", alert_id)
 
-            # Загрузка конфигурации и выполнение команд
-            config_path = "alerts_config.yaml"
-            if not os.path.exists(config_path):
-                logger.error(f"Файл конфигурации '{config_path}' не найден.")
+            # Поиск команд для alert_id
+            if not config_loaded:
+                config_loaded = True
+                try:
+                    _, commands_by_id = alert_config.load_config()
+                except FileNotFoundError:
+                    logger.error("Файл конфигурации '%s' не найден.", alert_config.CONFIG_PATH)
+                    config_error = "Configuration file not found"
+                except alert_config.ConfigError as e:
+                    logger.error("Ошибка в файле конфигурации '%s': %s", alert_config.CONFIG_PATH, e)
+                    config_error = f"Invalid configuration: {e}"
+
+            if config_error:
                 results.append({
                     "alert": alert_name,
-                    "error": "Configuration file not found"
+                    "error": config_error
                 })
                 continue
 
-            with open(config_path, "r") as f:
-                config = yaml.safe_load(f)
-
-            command_to_run = None
-            for item in config.get("alert", []):
-                if alert_id in item:
-                    command_to_run = item[alert_id].get("command")
-                    break
+            alert_commands = commands_by_id.get(alert_id)
 
-            if not command_to_run:
-                logger.warning(f"Команда для alert_id '{alert_id}' не найдена.")
+            if not alert_commands:
+                logger.warning("Команда для alert_id '%s' не найдена.", alert_id)
                 results.append({
                     "alert": alert_name,
                     "alert_id": alert_id,
@@ -129,79 +373,62 @@ def handle_alert(data: AlertRequest):
                 })
                 continue
 
-            # Приведение к списку
-            if not isinstance(command_to_run, list):
-                command_to_run = [command_to_run]
+            use_shell = alert_commands["shell"]
 
             # Подготовка словаря для подстановки меток
-            label_values = alert.labels
+            label_values = SafeDict(alert.labels)
 
             # Выполнение команд с подстановкой
-            for cmd_template in command_to_run:
-                try:
-                    cmd = cmd_template.format_map(SafeDict(label_values))
-                except Exception as e:
-                    logger.error(f"Ошибка при подстановке меток в команду '{cmd_template}': {e}")
+            for cmd_template, argv_template in alert_commands["commands"]:
+                if not use_shell and argv_template is None:
                     results.append({
                         "alert": alert_name,
                         "alert_id": alert_id,
                         "command_template": cmd_template,
-                        "error": f"Label substitution failed: {e}"
+                        "error": "Command parsing failed"
                     })
                     continue
 
-                logger.info(f"Выполняется команда: {cmd}")
+                # Без shell метки подставляются в каждый аргумент отдельно,
+                # поэтому значение метки не может добавить новые аргументы
                 try:
-                    result = subprocess.run(
-                        cmd,
-                        shell=True,
-                        check=True,
-                        stdout=subprocess.PIPE,
-                        stderr=subprocess.PIPE,
-                        text=True,
-                        timeout=60
-                    )
-                    stdout = result.stdout.strip()
-                    stderr = result.stderr.strip()
-
-                    logger.info(f"STDOUT: {stdout}")
-                    if stderr:
-                        logger.warning(f"STDERR: {stderr}")
-
+                    if use_shell:
+                        argv = None
+                        cmd = cmd_template.format_map(label_values)
+                    else:
+                        argv = [arg.format_map(label_values) for arg in argv_template]
+                        cmd = shlex.join(argv)
+                except Exception as e:
+                    logger.error("Ошибка при подстановке меток в команду '%s': %s", cmd_template, e)
                     results.append({
                         "alert": alert_name,
                         "alert_id": alert_id,
                         "command_template": cmd_template,
-                        "command_executed": cmd,
-                        "status": "success",
-                        "stdout": stdout,
-                        "stderr": stderr
+                        "error": f"Label substitution failed: {e}"
                     })
+                    continue
 
-                except subprocess.CalledProcessError as e:
-                    logger.error(f"Ошибка при выполнении команды: {e}")
-                    logger.error(f"STDOUT: {e.stdout.strip() if e.stdout else '(пусто)'}")
-                    logger.error(f"STDERR: {e.stderr.strip() if e.stderr else '(пусто)'}")
-                    results.append({
-                        "alert": alert_name,
-                        "alert_id": alert_id,
-                        "command_template": cmd_template,
-                        "command_executed": cmd,
-                        "status": "failed",
-                        "stdout": e.stdout.strip() if e.stdout else "",
-                        "stderr": e.stderr.strip() if e.stderr else ""
-                    })
-                except subprocess.TimeoutExpired as e:
-                    logger.error(f"Таймаут выполнения команды: {cmd}")
-                    results.append({
-                        "alert": alert_name,
-                        "alert_id": alert_id,
-                        "command_template": cmd_template,
-                        "command_executed": cmd,
-                        "status": "timeout",
-                        "stdout": "",
-                        "stderr": "Command timed out"
-                    })
+                # Команда запускается позже, вместе с остальными командами запроса
+                results.append({
+                    "alert": alert_name,
+                    "alert_id": alert_id,
+                    "command_template": cmd_template,
+                    "command_executed": cmd
+                })
+                pending.append((len(results) - 1, _run_command(
+                    alert_name, alert_id, cmd_template, cmd, argv,
+                    capture_output=alert_commands["capture_output"],
+                    max_output_bytes=alert_commands["max_output_bytes"]
+                )))
+
+        # Все команды запроса выполняются параллельно
+        outcomes = await asyncio.gather(*(coro for _, coro in pending), return_exceptions=True)
+        for (index, _), outcome in zip(pending, outcomes):
+            if isinstance(outcome, BaseException):
+                logger.error("Ошибка при запуске команды '%s': %r", results[index]["command_executed"], outcome)
+                results[index]["error"] = f"Command execution failed: {outcome}"
+            else:
+                results[index] = outcome
 
         return {"results": results}
 
@@ -213,4 +440,16 @@ def handle_alert(data: AlertRequest):
 # === Точка входа ===
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run("main:app", host="0.0.0.0", port=9999, reload=True)
+
+    if os.environ.get("ALERT_EXECUTOR_DEV") == "1":
+        # Режим разработки: перезапуск при изменении файлов, один процесс
+        uvicorn.run("main:app", host="0.0.0.0", port=9999, reload=True)
+    else:
+        uvicorn.run(
+            "main:app",
+            host="0.0.0.0",
+            port=9999,
+            loop="uvloop",
+            http="httptools",
+            workers=max(2, (os.cpu_count() or 1) // 2)
+        )